@@ -13,18 +13,81 @@
 # limitations under the License.
 
 import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from warnings import warn
 import numpy as np
+from scipy.sparse import csr_matrix
 import dimod
 from dwave.system import LeapHybridCQMSampler
 from fire import Fire
 from helper import load_from_yml, bars_plot, save_sequence_to_yaml
 
 
+_aggregate_threshold = 16
+_max_samplers = 8
+_samplers = {}
+
+
 # from Yarkoni et. al "Multi-car paint shop optimization with quantum
 # annealing: "https://arxiv.org/pdf/2109.07876.pdf
 
 
+@lru_cache(maxsize=16)
+def _get_switches_vectors(num_cars):
+    """Compute the coefficients of the number of color switches, which only
+    depend on the number of cars
+
+    Args:
+        num_cars (int): The number of cars
+
+    Returns:
+        tuple: The read-only linear biases and the `(row, col, quadratic)`
+            arrays of the quadratic interactions.
+
+    """
+    # (x_i+1 - x_i)^2 = x_i + x_i+1 - 2 x_i x_i+1 for binary variables
+    linear = np.zeros(num_cars)
+    linear[:-1] += 1
+    linear[1:] += 1
+    row = np.arange(num_cars - 1)
+    col = row + 1
+    quadratic = np.full(row.shape, -2.0)
+    for array in (linear, row, col, quadratic):
+        array.setflags(write=False)
+    return linear, (row, col, quadratic)
+
+
+def _group_ensembles(sequence):
+    """Group the positions of the cars of each ensemble in a single sorting
+    pass. Sequences whose labels do not survive the conversion to a numpy
+    array, or cannot be sorted, are grouped with a dictionary instead.
+
+    Args:
+        sequence (Iterable): the sequence of cars
+
+    Returns:
+        dict: The ensembles as keys and the lists of their car positions, in
+            increasing order, as values
+
+    """
+    try:
+        array = np.asarray(sequence)
+        if array.ndim == 1 and array.tolist() == list(sequence):
+            order = np.argsort(array, kind='stable')
+            ensembles, starts = np.unique(array[order], return_index=True)
+            return {car: index.tolist() for car, index in
+                    zip(ensembles.tolist(), np.split(order, starts[1:]))}
+    except TypeError:
+        pass
+
+    positions = {}
+    for i, car in enumerate(sequence):
+        positions.setdefault(car, []).append(i)
+    return positions
+
+
 def get_paint_shop_cqm(sequence, k, mode=1):
     """Create a CQM object for paint shop optimization problem
 
@@ -41,23 +104,46 @@ def get_paint_shop_cqm(sequence, k, mode=1):
             paint shop color switches
 
     """
-    x = [dimod.Binary(i) for i, car in enumerate(sequence)]
+    num_cars = len(sequence)
+    linear, (row, col, quadratic) = _get_switches_vectors(num_cars)
+
     cqm = dimod.ConstrainedQuadraticModel()
-    num_switches = dimod.quicksum(
-        (x[i + 1] - x[i]) ** 2 for i in range(len(x) - 1))
+    num_switches = dimod.BinaryQuadraticModel.from_numpy_vectors(
+        linear, (row, col, quadratic), 0.0, 'BINARY')
     if mode == 1:
         cqm.set_objective(num_switches)
     else:
-        cqm.set_objective(dimod.quicksum(
-            -(2 * x[i] - 1) * (2 * x[i + 1] - 1) for i in range(len(x) - 1)))
+        # -(2 x_i - 1)(2 x_i+1 - 1) = 2 (x_i+1 - x_i)^2 - 1
+        cqm.set_objective(dimod.BinaryQuadraticModel.from_numpy_vectors(
+            2 * linear, (row, col, 2 * quadratic), 1 - num_cars, 'BINARY'))
 
+    positions = _group_ensembles(sequence)
     for car, number in k.items():
-        index = [i for i, c in enumerate(sequence) if c == car]
-        constraint = dimod.quicksum(x[i] for i in index)
-        cqm.add_constraint(constraint == number)
+        cqm.add_constraint_from_iterable(
+            ((i, 1.0) for i in positions.get(car, [])), sense='==',
+            rhs=number, label=f'ensemble_{car}')
     return cqm, num_switches
 
 
+def _get_black_counts(rng, counts, min_black=None, max_black=None):
+    """Draw the number of black cars for every ensemble at once
+
+    Args:
+        rng (np.random.Generator): The random number generator
+        counts (np.ndarray): number of cars in each ensemble
+        min_black (int): Minimum number of black cars for each ensemble
+        max_black (int): Maximum number of black cars for each ensemble
+
+    Returns:
+        np.ndarray: number of black cars for each ensemble
+
+    """
+    low = np.full_like(counts, min_black) if min_black else counts // 3
+    high = np.full_like(counts, max_black) if max_black else 2 * counts // 3
+    high = np.maximum(high, low + 1)
+    return rng.integers(low, high)
+
+
 def get_random_sequence(num_cars=5, seed=111, num_car_ensembles=8,
                         min_black=None, max_black=None):
     """Generate a random paint shop problem
@@ -79,17 +165,13 @@ def get_random_sequence(num_cars=5, seed=111, num_car_ensembles=8,
             keys and values.
 
     """
-    np.random.seed(seed)
-    sequence = np.random.randint(0, num_car_ensembles, size=num_cars)
+    rng = np.random.default_rng(seed)
+    # the narrowest integer type that fits all ensembles, int8 in most cases
+    dtype = np.min_scalar_type(-num_car_ensembles)
+    sequence = rng.integers(0, num_car_ensembles, size=num_cars, dtype=dtype)
     unique, counts = np.unique(sequence, return_counts=True)
-    counts = dict(zip(unique, counts))
-    mapping = {}
-    for ensemble, cars in counts.items():
-        a = int(cars * 1 / 3) if not min_black else min_black
-        b = int(cars * 2 / 3) if not max_black else max_black
-        if b <= a:
-            b = a + 1
-        mapping[ensemble] = np.random.randint(a, b)
+    black = _get_black_counts(rng, counts, min_black, max_black)
+    mapping = dict(zip(unique.tolist(), black.tolist()))
     return sequence, mapping
 
 
@@ -113,11 +195,77 @@ def get_paint_shop_bqm(cqm: dimod.ConstrainedQuadraticModel, penalty=2.0):
     bqm.offset = cqm.objective.offset
     bqm.add_linear_from(cqm.objective.linear)
     bqm.add_quadratic_from(cqm.objective.quadratic)
-    for c in cqm.constraints.values():
-        bqm += penalty * (c.lhs - c.rhs) ** 2
+
+    # penalty * ||A x - b||^2 for binary variables, where x_i^2 = x_i
+    labels = np.array(list(cqm.variables), dtype=object)
+    row, col, data, rhs = [], [], [], []
+    for i, c in enumerate(cqm.constraints.values()):
+        row.extend([i] * len(c.lhs.linear))
+        col.extend(cqm.variables.index(v) for v in c.lhs.linear)
+        data.extend(c.lhs.linear.values())
+        rhs.append(c.rhs - c.lhs.offset)
+    a = csr_matrix((data, (row, col)), shape=(len(rhs), len(labels)))
+    b = np.asarray(rhs, dtype=float)
+    h = (a.T @ a).tocoo()
+    upper = h.row < h.col
+
+    linear = penalty * (h.diagonal() - 2 * (a.T @ b))
+    bqm.add_linear_from(zip(labels.tolist(), linear.tolist()))
+    bqm.add_quadratic_from(zip(labels[h.row[upper]].tolist(),
+                               labels[h.col[upper]].tolist(),
+                               (2 * penalty * h.data[upper]).tolist()))
+    bqm.offset += penalty * (b @ b)
     return bqm
 
 
+def filter_feasible(cqm, sampleset, atol=1e-6):
+    """Filter the feasible samples of a sample set, assuming that only
+    equality constraints are present.
+
+    Args:
+        cqm: The `dimod.ConstrainedQuadraticModel for paint shop optimization
+        sampleset (dimod.SampleSet): Samples of the variables of `cqm`
+        atol (float): Absolute tolerance for the constraint violations
+
+    Returns:
+        `dimod.SampleSet`: A sample set with only the feasible samples
+
+    """
+    samples = (sampleset.record.sample, sampleset.variables)
+    feasible = np.ones(len(sampleset), dtype=bool)
+    for c in cqm.constraints.values():
+        feasible &= np.abs(c.lhs.energies(samples) - c.rhs) <= atol
+    return dimod.SampleSet(sampleset.record[feasible], sampleset.variables,
+                           sampleset.info, sampleset.vartype)
+
+
+def _get_sampler(config):
+    """Get a CQM sampler, reusing the one created earlier for the same solver
+    client configuration. At most `_max_samplers` samplers are kept, and the
+    client of the least recently used one is closed when it is dropped.
+
+    Args:
+        config (dict): Keyword arguments passed to the solver client. They
+            are compared through their JSON serialization, and a sampler is
+            created without caching if they cannot be serialized.
+
+    Returns:
+        `dwave.system.LeapHybridCQMSampler`: A hybrid CQM sampler
+
+    """
+    try:
+        key = json.dumps(config, sort_keys=True)
+    except (TypeError, ValueError):
+        return LeapHybridCQMSampler(**config)
+    sampler = _samplers.pop(key, None)
+    if sampler is None:
+        sampler = LeapHybridCQMSampler(**config)
+        while len(_samplers) >= _max_samplers:
+            _samplers.pop(next(iter(_samplers))).client.close()
+    _samplers[key] = sampler
+    return sampler
+
+
 def main(num_cars=10, seed=111, mode=1,
          num_car_ensembles=3, min_black=None, max_black=None,
          save_sequence=False, sequence_name=None,
@@ -176,8 +324,11 @@ def main(num_cars=10, seed=111, mode=1,
             print('The sequence is too long, please save it '
                   'by passing --save-sequence as argument')
 
-    cqm, num_switches = get_paint_shop_cqm(sequence, mapping, mode)
-    sampler = LeapHybridCQMSampler(**config)
+    # connect to the solver while the CQM is being built
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(_get_sampler, config)
+        cqm, num_switches = get_paint_shop_cqm(sequence, mapping, mode)
+        sampler = future.result()
 
     min_time_limit = sampler.min_time_limit(cqm)
     if time_limit and time_limit < min_time_limit:
@@ -185,25 +336,32 @@ def main(num_cars=10, seed=111, mode=1,
         warn('Time limit is less than the minimum allowed, '
              f'changing to the minimum allowed {min_time_limit}')
 
-    sampleset = sampler.sample_cqm(cqm, time_limit=time_limit).aggregate()
-    sampleset = sampleset.filter(lambda x: cqm.check_feasible(x.sample))
+    # the sample set is resolved asynchronously, on first access
+    sampleset = sampler.sample_cqm(cqm, time_limit=time_limit)
     if filename is None:
         image_name = f'color_sequence_image'
     else:
         image_name = f'{filename}_color_sequence_image'
 
+    # hybrid solvers return few, mostly distinct samples
+    if len(sampleset) > _aggregate_threshold:
+        sampleset = sampleset.aggregate()
+    sampleset = filter_feasible(cqm, sampleset)
+
     print('\nSolutions')
     print('---------')
     if len(sampleset) == 0:
         print('No feasible solution found.')
     else:
         sampleset = sampleset.truncate(3)
-        for index, sample in enumerate(sampleset.samples()):
+        samples = (sampleset.record.sample, sampleset.variables)
+        energies = zip(sampleset.samples(sorted_by=None),
+                       cqm.objective.energies(samples),
+                       num_switches.energies(samples))
+        for index, (sample, objective, switches) in enumerate(energies):
             print(f'{index + 1:}  ')
-            print(f'Objective: '
-                  f'{cqm.objective.energy(sample): 8.2f}, ', end='')
-            print(f'Number of switches: '
-                  f'{num_switches.energy(sample): 8.2f}')
+            print(f'Objective: {objective: 8.2f}, ', end='')
+            print(f'Number of switches: {switches: 8.2f}')
             bars_plot(sample,
                       name=image_name + f'_{index}_{mode}.png')
 
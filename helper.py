@@ -13,15 +13,87 @@
 # limitations under the License.
 
 import os
+import copy
+from functools import lru_cache
 from typing import Mapping
 import yaml
-import dimod
 import numpy as np
-import matplotlib.pyplot as plt
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
-_golden_ratio = (1 + 5 ** 0.5) / 2
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+_inverse_golden_ratio = 2 / (1 + 5 ** 0.5)
 _folder_name = 'images'
+_figure = None
+_axes = None
+_agg_selected = False
+
+
+@lru_cache(maxsize=128)
+def _parse_yml(filename, mtime_ns, size):
+    """Parse a yaml file once for each modification time and size. When
+    msgpack is installed, the parsed data is also stored in a sidecar file
+    next to the yaml file, together with the modification time and size it
+    was parsed from, and read from there while both still match.
+
+    Args:
+        filename (str): The absolute path of the yaml file
+        mtime_ns (int): The modification time of the file, in nanoseconds
+        size (int): The size of the file, in bytes
+
+    Returns:
+        The content of the yaml file, shared between calls with the same
+            arguments
+
+    """
+    sidecar = filename + '.msgpack'
+    if msgpack is not None:
+        try:
+            with open(sidecar, 'rb') as file_handle:
+                source = msgpack.unpack(file_handle, raw=False,
+                                        strict_map_key=False)
+            if source[:2] == [mtime_ns, size]:
+                return source[2]
+        except (OSError, ValueError, TypeError, IndexError,
+                msgpack.UnpackException):
+            pass
+
+    with open(filename, 'rb') as file_handle:
+        # only the first document is used, as with safe_load_all
+        data = next(iter(yaml.load_all(file_handle, Loader=SafeLoader)))
+
+    if msgpack is not None:
+        try:
+            packed = msgpack.packb([mtime_ns, size, data])
+            with open(sidecar, 'wb') as file_handle:
+                file_handle.write(packed)
+        except (OSError, TypeError, ValueError, OverflowError):
+            pass
+    return data
+
+
+def _load_yml(filename):
+    """Load a yaml file, parsing it again only if it has changed
+
+    Args:
+        filename (str): The name of the yaml file (use full or relative path)
+
+    Returns:
+        The content of the yaml file, as a copy that is safe to modify
+
+    """
+    stat = os.stat(filename)
+    data = _parse_yml(os.path.abspath(filename), stat.st_mtime_ns,
+                      stat.st_size)
+    return copy.deepcopy(data)
 
 
 def load_from_yml(filename):
@@ -37,9 +109,7 @@ def load_from_yml(filename):
             number of black cars as keys and values, respectively.
 
     """
-
-    with open(filename, 'r') as file_handle:
-        data = next(iter(yaml.safe_load_all(file_handle)))
+    data = _load_yml(filename)
     sequence = data['sequence']
     k = data['counts']
     return sequence, k
@@ -86,9 +156,52 @@ def load_experiment_from_yml(filename):
         dict: The yaml file as a dictionary
 
     """
-    with open(filename, 'r') as file_handle:
-        data = next(iter(yaml.safe_load_all(file_handle)))
-    return data
+    return _load_yml(filename)
+
+
+def _import_pyplot(show):
+    """Import `matplotlib.pyplot`, selecting the non-interactive Agg backend
+    if plots are only saved and no backend was configured, so that no
+    interactive backend is probed. Showing a plot after Agg was selected
+    switches back to the configured backend, which closes all open figures.
+
+    Args:
+        show (bool): Whether plots are going to be shown
+
+    Returns:
+        module: The `matplotlib.pyplot` module
+
+    """
+    global _agg_selected
+    import matplotlib
+    # the rc backend stays the auto sentinel until one is configured or used;
+    # the sentinel is private, so Agg is not forced if it is missing
+    sentinel = getattr(matplotlib.rcsetup, '_auto_backend_sentinel', None)
+    if (not show and sentinel is not None
+            and dict.get(matplotlib.rcParams, 'backend') is sentinel):
+        matplotlib.use('Agg')
+        _agg_selected = True
+    import matplotlib.pyplot as plt
+    if show and _agg_selected:
+        plt.switch_backend(matplotlib.rcParamsOrig['backend'])
+        _agg_selected = False
+    return plt
+
+
+def _get_axes():
+    """Get the figure and axes reused by all bar plots, creating them on
+    first use or after the figure has been closed
+
+    Returns:
+        tuple: The `matplotlib` figure and axes
+
+    """
+    import matplotlib.pyplot as plt
+
+    global _figure, _axes
+    if _figure is None or not plt.fignum_exists(_figure.number):
+        _figure, _axes = plt.subplots()
+    return _figure, _axes
 
 
 def bars_plot(sampleset, show=False, save=True, name='image.png',
@@ -96,33 +209,43 @@ def bars_plot(sampleset, show=False, save=True, name='image.png',
     """Create a bar image for a given binary string.
 
     Args:
-        sampleset (dimod.SampleSet): `dimod.SampleSet` or a sample-like
+        sampleset (dimod.SampleSet): `dimod.SampleSet` or a sample-like,
+            with binary values of 0 or 1 (stored as `np.uint8`)
         show (bool): Whether to show the plot (default=False)
         save (bool): Whether to save the plot (default=True)
         name (str): A file name to save the plot (default='image.png')
         folder_name (str): The folder to save images (default=None)
 
     """
+    # imported here so that loading data does not pay for the imports
+    import dimod
+    plt = _import_pyplot(show)
+
     if folder_name is None:
         folder_name = _folder_name
     if isinstance(sampleset, dimod.SampleSet):
-        sample = sampleset.first.sample
-        sample = [sample[v] for v in sampleset.variables]
+        # the lowest-energy row, as in `sampleset.first`
+        record = sampleset.record
+        sample = record.sample[record.energy.argmin()]
+        sample = sample.astype(np.uint8, copy=False)
     elif isinstance(sampleset, Mapping):
-        sample = [v for key, v in sampleset.items()]
+        sample = np.fromiter(sampleset.values(), dtype=np.uint8,
+                             count=len(sampleset))
     else:
         sample = sampleset
 
-    width = int(len(sample) / _golden_ratio)
-    sample = 1 - np.array(sample)
-    plt.imshow(np.repeat(sample, width).reshape(-1, width).T, cmap='gray')
-    plt.yticks([])
+    width = int(len(sample) * _inverse_golden_ratio)
+    sample = 1 - np.asarray(sample, dtype=np.uint8)
+    image = np.tile(sample, (width, 1))
+    figure, axes = _get_axes()
+    axes.clear()
+    axes.imshow(image, cmap='gray')
+    axes.set_yticks([])
     if save:
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name)
+        os.makedirs(folder_name, exist_ok=True)
         filename = os.path.basename(name)
         filename = os.path.join(folder_name, filename)
-        plt.savefig(filename)
+        figure.savefig(filename)
         print(f'Saved solution to {filename}')
     if show:
         plt.show()
@@ -14,13 +14,20 @@
 
 import os
 import sys
+import subprocess
 import uuid
+import shutil
+import tempfile
 import dimod
 import unittest
+from unittest import mock
+import numpy as np
 from car_paint_shop import get_paint_shop_cqm, get_random_sequence
-from car_paint_shop import get_paint_shop_bqm
+from car_paint_shop import get_paint_shop_bqm, filter_feasible
+import car_paint_shop
 from helper import bars_plot, load_from_yml, load_experiment_from_yml
 from helper import save_sequence_to_yaml
+import helper
 
 # Add the parent path so that the test file can be run as a script in
 # addition to using "python -m unittest" from the root directory
@@ -29,108 +36,176 @@ sys.path.append(example_dir)
 
 
 class TestCarPaintShop(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        sequence = [1, 2, 3, 1, 2, 3]
+        counts = {1: 1, 2: 1, 3: 1}
+        cls.cqm_m1, cls.obj_m1 = get_paint_shop_cqm(sequence, counts, mode=1)
+        cls.cqm_m2, cls.obj_m2 = get_paint_shop_cqm(sequence, counts, mode=2)
+        cls.bqm_m1 = get_paint_shop_bqm(cls.cqm_m1, penalty=10)
+        cls.bqm_m2 = get_paint_shop_bqm(cls.cqm_m2, penalty=10)
+        cls.samples = (np.array([[1, 1, 1, 0, 0, 0],
+                                 [1, 1, 1, 1, 0, 0],
+                                 [1, 0, 1, 0, 1, 0]], dtype=np.int8), range(6))
+
+    def feasible(self, cqm):
+        """Check the feasibility of each test sample with dimod"""
+        samples, labels = self.samples
+        return [cqm.check_feasible(dict(zip(labels, sample)))
+                for sample in samples.tolist()]
+
     def test_sequence(self):
         sequence, counts = get_random_sequence(10, num_car_ensembles=5)
         self.assertEqual(len(sequence), 10)
         self.assertEqual(len(counts), 5)
 
-    def test_solution(self):
-        """Verify that the expected solution is obtained"""
-        sequence = [1, 2, 3, 1, 2, 3]
-        counts = {1: 1, 2: 1, 3: 1}
-        cqm, _ = get_paint_shop_cqm(sequence, counts, mode=1)
+    def test_sequence_black_bounds(self):
+        sequence, counts = get_random_sequence(100, num_car_ensembles=4)
+        for ensemble, black in counts.items():
+            cars = sum(1 for c in sequence if c == ensemble)
+            self.assertGreaterEqual(black, cars // 3)
+            self.assertLess(black, max(2 * cars // 3, cars // 3 + 1))
 
-        sample = {0: 1, 1: 1, 2: 1, 3: 0, 4: 0, 5: 0}
-        self.assertTrue(cqm.check_feasible(sample))
-        self.assertAlmostEqual(cqm.objective.energy(sample), 1)
-        sample = {0: 1, 1: 1, 2: 1, 3: 1, 4: 0, 5: 0}
-        self.assertFalse(cqm.check_feasible(sample))
-        self.assertAlmostEqual(cqm.objective.energy(sample), 1)
-        sample = {0: 1, 1: 0, 2: 1, 3: 0, 4: 1, 5: 0}
-        self.assertTrue(cqm.check_feasible(sample))
-        self.assertAlmostEqual(cqm.objective.energy(sample), 5)
-
-    def test_solution_mode2(self):
-        """Verify that the expected solution is obtained"""
-        sequence = [1, 2, 3, 1, 2, 3]
-        counts = {1: 1, 2: 1, 3: 1}
-        cqm, _ = get_paint_shop_cqm(sequence, counts, mode=2)
+        sequence, counts = get_random_sequence(
+            100, num_car_ensembles=4, min_black=5, max_black=8)
+        for black in counts.values():
+            self.assertIn(black, range(5, 8))
 
-        sample = {0: 1, 1: 1, 2: 1, 3: 0, 4: 0, 5: 0}
-        self.assertTrue(cqm.check_feasible(sample))
-        self.assertAlmostEqual(cqm.objective.energy(sample), -3)
-        sample = {0: 1, 1: 1, 2: 1, 3: 1, 4: 0, 5: 0}
-        self.assertFalse(cqm.check_feasible(sample))
-        self.assertAlmostEqual(cqm.objective.energy(sample), -3)
-        sample = {0: 1, 1: 0, 2: 1, 3: 0, 4: 1, 5: 0}
-        self.assertTrue(cqm.check_feasible(sample))
-        self.assertAlmostEqual(cqm.objective.energy(sample), 5)
-
-    def test_solution2(self):
-        """Verify that the expected solution is obtained"""
-        sequence = [1, 2, 3, 1, 2, 3]
-        counts = {1: 1, 2: 1, 3: 1}
-        cqm, objective = get_paint_shop_cqm(sequence, counts, mode=1)
+    def test_solutions(self):
+        """Verify that the expected solutions are obtained"""
+        cases = [(1, self.cqm_m1, self.obj_m1, [1, 1, 5]),
+                 (2, self.cqm_m2, self.obj_m2, [-3, -3, 5])]
+        for mode, cqm, objective, energies in cases:
+            with self.subTest(mode=mode):
+                np.testing.assert_array_equal(self.feasible(cqm),
+                                              [True, False, True])
+                np.testing.assert_allclose(
+                    cqm.objective.energies(self.samples), energies)
+                np.testing.assert_allclose(
+                    objective.energies(self.samples), [1, 1, 5])
 
-        sample = {0: 1, 1: 1, 2: 1, 3: 0, 4: 0, 5: 0}
-        self.assertTrue(cqm.check_feasible(sample))
-        self.assertAlmostEqual(cqm.objective.energy(sample), 1)
-        self.assertAlmostEqual(objective.energy(sample), 1)
-        sample = {0: 1, 1: 1, 2: 1, 3: 1, 4: 0, 5: 0}
-        self.assertFalse(cqm.check_feasible(sample))
-        self.assertAlmostEqual(cqm.objective.energy(sample), 1)
-        self.assertAlmostEqual(objective.energy(sample), 1)
-        sample = {0: 1, 1: 0, 2: 1, 3: 0, 4: 1, 5: 0}
-        self.assertTrue(cqm.check_feasible(sample))
-        self.assertAlmostEqual(cqm.objective.energy(sample), 5)
-        self.assertAlmostEqual(objective.energy(sample), 5)
-
-    def test_solution2_mode2(self):
-        """Verify that the expected solution is obtained"""
-        sequence = [1, 2, 3, 1, 2, 3]
-        counts = {1: 1, 2: 1, 3: 1}
+    def test_objective_symbolic(self):
+        """Verify that the objectives match their symbolic formulation"""
+        sequence, counts = get_random_sequence(20, num_car_ensembles=4)
+        x = [dimod.Binary(i) for i in range(len(sequence))]
+        switches = dimod.quicksum(
+            (x[i + 1] - x[i]) ** 2 for i in range(len(x) - 1))
+        spins = dimod.quicksum(
+            -(2 * x[i] - 1) * (2 * x[i + 1] - 1) for i in range(len(x) - 1))
+
+        cqm, objective = get_paint_shop_cqm(sequence, counts, mode=1)
+        self.assertTrue(cqm.objective.is_equal(switches))
+        self.assertTrue(objective.is_equal(switches))
         cqm, objective = get_paint_shop_cqm(sequence, counts, mode=2)
+        self.assertTrue(cqm.objective.is_equal(spins))
+        self.assertTrue(objective.is_equal(switches))
 
-        sample = {0: 1, 1: 1, 2: 1, 3: 0, 4: 0, 5: 0}
-        self.assertTrue(cqm.check_feasible(sample))
-        self.assertAlmostEqual(cqm.objective.energy(sample), -3)
-        self.assertAlmostEqual(objective.energy(sample), 1)
-        sample = {0: 1, 1: 1, 2: 1, 3: 1, 4: 0, 5: 0}
-        self.assertFalse(cqm.check_feasible(sample))
-        self.assertAlmostEqual(cqm.objective.energy(sample), -3)
-        self.assertAlmostEqual(objective.energy(sample), 1)
-        sample = {0: 1, 1: 0, 2: 1, 3: 0, 4: 1, 5: 0}
-        self.assertTrue(cqm.check_feasible(sample))
-        self.assertAlmostEqual(cqm.objective.energy(sample), 5)
-        self.assertAlmostEqual(objective.energy(sample), 5)
+    def test_constraints_labels(self):
+        """Verify that constraints are grouped by ensemble for string labels"""
+        sequence = ['c1', 'c2', 'c1', 'c3', 'c2', 'c1']
+        counts = {'c1': 2, 'c2': 1, 'c3': 0}
+        cqm, _ = get_paint_shop_cqm(sequence, counts, mode=1)
+
+        variables = sorted(
+            sorted(c.lhs.variables) for c in cqm.constraints.values())
+        self.assertEqual(variables, [[0, 2, 5], [1, 4], [3]])
+        self.assertTrue(cqm.check_feasible(
+            {0: 1, 1: 1, 2: 1, 3: 0, 4: 0, 5: 0}))
+        self.assertFalse(cqm.check_feasible(
+            {0: 1, 1: 1, 2: 1, 3: 1, 4: 0, 5: 0}))
+
+    def test_constraints_mixed_labels(self):
+        for sequence, counts in (([1, 'a', 1], {1: 1, 'a': 1}),
+                                 ([None, 2, None], {None: 1, 2: 0})):
+            with self.subTest(sequence=sequence):
+                cqm, _ = get_paint_shop_cqm(sequence, counts)
+                lhs = [set(c.lhs.variables)
+                       for c in cqm.constraints.values()]
+                self.assertEqual(lhs, [{0, 2}, {1}])
+
+    def test_filter_feasible(self):
+        """Verify that only the feasible samples are kept"""
+        cqm = self.cqm_m1
+        sampleset = dimod.SampleSet.from_samples_cqm(
+            [{0: 1, 1: 1, 2: 1, 3: 0, 4: 0, 5: 0},
+             {0: 1, 1: 1, 2: 1, 3: 1, 4: 0, 5: 0},
+             {0: 1, 1: 0, 2: 1, 3: 0, 4: 1, 5: 0}], cqm)
+
+        feasible = filter_feasible(cqm, sampleset)
+        self.assertEqual(len(feasible), 2)
+        for sample in feasible.samples():
+            self.assertTrue(cqm.check_feasible(sample))
 
     def test_bqm(self):
         """Verify that the expected solution is obtained"""
-        sequence = [1, 2, 3, 1, 2, 3]
-        counts = {1: 1, 2: 1, 3: 1}
-        cqm, objective = get_paint_shop_cqm(sequence, counts, mode=1)
-        bqm = get_paint_shop_bqm(cqm, penalty=10)
+        np.testing.assert_allclose(self.bqm_m1.energies(self.samples),
+                                   [1, 11, 5])
+
+    def test_bqm_symbolic(self):
+        """Verify that the penalties match their symbolic formulation"""
+        sequence, counts = get_random_sequence(20, num_car_ensembles=4)
+        cqm, _ = get_paint_shop_cqm(sequence, counts, mode=2)
+        bqm = get_paint_shop_bqm(cqm, penalty=3)
 
-        sample = {0: 1, 1: 1, 2: 1, 3: 0, 4: 0, 5: 0}
-        self.assertAlmostEqual(bqm.energy(sample), 1)
-        sample = {0: 1, 1: 1, 2: 1, 3: 1, 4: 0, 5: 0}
-        self.assertAlmostEqual(bqm.energy(sample), 11)
-        sample = {0: 1, 1: 0, 2: 1, 3: 0, 4: 1, 5: 0}
-        self.assertAlmostEqual(bqm.energy(sample), 5)
+        expected = dimod.BinaryQuadraticModel('BINARY')
+        expected += cqm.objective
+        for c in cqm.constraints.values():
+            expected += 3 * (c.lhs - c.rhs) ** 2
+        self.assertTrue(bqm.is_almost_equal(expected))
 
     def test_bqm_mode2(self):
         """Verify that the expected solution is obtained"""
-        sequence = [1, 2, 3, 1, 2, 3]
-        counts = {1: 1, 2: 1, 3: 1}
-        cqm, objective = get_paint_shop_cqm(sequence, counts, mode=2)
-        bqm = get_paint_shop_bqm(cqm, penalty=10)
+        np.testing.assert_allclose(self.bqm_m2.energies(self.samples),
+                                   [-3, 7, 5])
+
+
+class _FakeSampler:
+    """Stand-in for the hybrid CQM sampler that solves problems exactly"""
+    def __init__(self, **config):
+        self.config = config
+        self.client = mock.Mock()
+
+    def min_time_limit(self, cqm):
+        return 5
+
+    def sample_cqm(self, cqm, time_limit=None):
+        return dimod.ExactCQMSolver().sample_cqm(cqm)
+
+
+@mock.patch.object(car_paint_shop, 'bars_plot')
+@mock.patch.object(car_paint_shop, 'LeapHybridCQMSampler', _FakeSampler)
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        car_paint_shop._samplers.clear()
+
+    def test_dict_config(self, bars_plot):
+        config = {'solver': {'name': 'x'}}
+        car_paint_shop.main(num_cars=6, num_car_ensembles=2, **config)
+        sampler = car_paint_shop._get_sampler(config)
+        self.assertEqual(sampler.config, config)
+        self.assertIs(car_paint_shop._get_sampler(
+            {'solver': {'name': 'x'}}), sampler)
+        self.assertIsNot(car_paint_shop._get_sampler(
+            {'solver': {'name': 'y'}}), sampler)
+        self.assertTrue(bars_plot.called)
 
-        sample = {0: 1, 1: 1, 2: 1, 3: 0, 4: 0, 5: 0}
-        self.assertAlmostEqual(bqm.energy(sample), -3)
-        sample = {0: 1, 1: 1, 2: 1, 3: 1, 4: 0, 5: 0}
-        self.assertAlmostEqual(bqm.energy(sample), 7)
-        sample = {0: 1, 1: 0, 2: 1, 3: 0, 4: 1, 5: 0}
-        self.assertAlmostEqual(bqm.energy(sample), 5)
+    def test_unserializable_config(self, bars_plot):
+        circular = {}
+        circular['solver'] = circular
+        for config in ({'solver': {'name': object()}}, circular):
+            with self.subTest(config=config):
+                sampler = car_paint_shop._get_sampler(config)
+                self.assertEqual(sampler.config, config)
+                self.assertIsNot(car_paint_shop._get_sampler(config), sampler)
+
+    def test_sampler_cache_bound(self, bars_plot):
+        first = car_paint_shop._get_sampler({'token': 0})
+        for token in range(1, car_paint_shop._max_samplers + 1):
+            car_paint_shop._get_sampler({'token': token})
+        self.assertEqual(len(car_paint_shop._samplers),
+                         car_paint_shop._max_samplers)
+        first.client.close.assert_called_once_with()
+        self.assertIsNot(car_paint_shop._get_sampler({'token': 0}), first)
 
 
 class TestHelper(unittest.TestCase):
@@ -169,16 +244,38 @@ class TestHelper(unittest.TestCase):
         os.remove(full_path)
         os.rmdir(folder)
 
+    def _plot_backend(self, setup=''):
+        """Get the backend after a bar plot in a fresh interpreter"""
+        code = (f'import matplotlib\n{setup}\nimport helper\n'
+                'helper.bars_plot([0, 1, 1, 0], save=False)\n'
+                'print(matplotlib.get_backend())')
+        env = {k: v for k, v in os.environ.items() if k != 'MPLBACKEND'}
+        result = subprocess.run([sys.executable, '-c', code], cwd=example_dir,
+                                env=env, capture_output=True, text=True,
+                                check=True)
+        return result.stdout.split()[-1].lower()
+
+    def test_backend_agg(self):
+        self.assertEqual(self._plot_backend(), 'agg')
+
+    def test_backend_configured(self):
+        self.assertEqual(self._plot_backend("matplotlib.use('svg')"), 'svg')
+
     def test_image_sampleset(self):
         sampleset = dimod.SampleSet.from_samples(
             [{0: 0, 1: 1, 2: 0, 3: 1}], 'BINARY', energy=[0])
         bars_plot(sampleset, show=False, save=False)
 
     def test_load_yaml(self):
-        load_from_yml('data/exp.yml')
+        # load a copy so that no msgpack sidecar is left in the data folder
+        with tempfile.TemporaryDirectory() as folder:
+            filename = shutil.copy('data/exp.yml', folder)
+            load_from_yml(filename)
 
     def test_load_exp_yaml(self):
-        load_experiment_from_yml('data/exp.yml')
+        with tempfile.TemporaryDirectory() as folder:
+            filename = shutil.copy('data/exp.yml', folder)
+            load_experiment_from_yml(filename)
 
     def test_save_sequence(self):
         filename = str(uuid.uuid4()) + '.yml'
@@ -189,3 +286,51 @@ class TestHelper(unittest.TestCase):
         self.assertEqual(seq, seq2)
         self.assertEqual(counts, counts2)
         os.remove(filename)
+        if os.path.exists(filename + '.msgpack'):
+            os.remove(filename + '.msgpack')
+
+    def test_load_yaml_cached(self):
+        filename = str(uuid.uuid4()) + '.yml'
+        save_sequence_to_yaml([0, 1, 0], {0: 1, 1: 0}, filename)
+        seq, counts = load_from_yml(filename)
+        seq.append(1)
+        self.assertEqual(load_from_yml(filename), ([0, 1, 0], {0: 1, 1: 0}))
+
+        save_sequence_to_yaml([1, 1, 0, 0], {0: 1, 1: 2}, filename)
+        self.assertEqual(load_from_yml(filename),
+                         ([1, 1, 0, 0], {0: 1, 1: 2}))
+        os.remove(filename)
+        if os.path.exists(filename + '.msgpack'):
+            os.remove(filename + '.msgpack')
+
+    def test_load_yaml_big_int(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'big.yml')
+            with open(filename, 'w') as file_handle:
+                file_handle.write('big: 100000000000000000000000\n')
+            self.assertEqual(load_experiment_from_yml(filename),
+                             {'big': 100000000000000000000000})
+
+    def test_load_yaml_restored(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'exp.yml')
+            save_sequence_to_yaml([0, 1, 0], {0: 1, 1: 0}, filename)
+            stat = os.stat(filename)
+            load_from_yml(filename)
+
+            save_sequence_to_yaml([1, 1, 0, 0], {0: 1, 1: 2}, filename)
+            load_from_yml(filename)
+
+            # restore the first version with its original modification time
+            save_sequence_to_yaml([0, 1, 0], {0: 1, 1: 0}, filename)
+            os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            helper._parse_yml.cache_clear()
+            self.assertEqual(load_from_yml(filename),
+                             ([0, 1, 0], {0: 1, 1: 0}))
+
+    def test_load_yaml_first_document(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'exp.yml')
+            with open(filename, 'w') as file_handle:
+                file_handle.write('a: 1\n---\nb: 2\n')
+            self.assertEqual(load_experiment_from_yml(filename), {'a': 1})